@@ -2,6 +2,48 @@
 import copy
 import numpy as np
 from abc import ABC, abstractmethod
+from scipy.integrate import odeint
+from scipy.linalg.blas import get_blas_funcs
+try:
+    import numba
+    from . import Kernels
+except ImportError:
+    numba = None
+
+# Allocate an array with aligned memory
+def _aligned_empty(shape, dtype = np.float64, align = 64, order = 'C'):
+    '''
+    Allocate an uninitialized array whose data address is a multiple of align bytes (for aligned SIMD loads).
+        Parameters:
+            shape (tuple): Shape of the array.
+            dtype (numpy.dtype): Data type of the array.
+            align (int): Alignment in bytes.
+            order (str): Memory layout, 'C' or 'F'.
+        Returns:
+            res (numpy.ndarray): Aligned array.
+    '''
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    buffer = np.empty(nbytes + align, dtype = np.uint8)
+    offset = -buffer.ctypes.data % align
+    return buffer[offset:offset + nbytes].view(dtype).reshape(shape, order = order)
+
+# Type of the deviation vectors
+def _LTM_dtype(jacobian, W):
+    '''
+    Get the type in which deviation vectors are propagated: the type of W if it is inexact (single precision W being kept),
+    promoted to float for an integer W and to complex for a complex jacobian.
+        Parameters:
+            jacobian (numpy.ndarray): Jacobian of f at the current state.
+            W (numpy.ndarray): Array of deviations vectors.
+        Returns:
+            dtype (numpy.dtype): Type of the deviation vectors at next time step.
+    '''
+    if not np.issubdtype(W.dtype, np.inexact):
+        return np.result_type(jacobian, W, float)
+    if np.issubdtype(jacobian.dtype, np.complexfloating):
+        return np.result_type(W, np.complex64)
+    return W.dtype
 
 # Abstract class for dynamical systems
 class DynamicalSystem(ABC):
@@ -25,6 +67,20 @@ class DynamicalSystem(ABC):
         self.jac = jac
         self.dt = dt
     
+    @property
+    def dt(self):
+        '''
+        Time interval between two time steps.
+        '''
+        return self._dt
+
+    @dt.setter
+    def dt(self, dt):
+        # dt/2 and dt/6 are cached for the RK4 steps and must follow dt
+        self._dt = dt
+        self._dt_half = dt * 0.5
+        self._dt_sixth = dt / 6.
+    
     def copy(self):
         '''
         Copy a dynamical system.
@@ -33,6 +89,22 @@ class DynamicalSystem(ABC):
          '''
         return copy.deepcopy(self)
 
+    def snapshot(self):
+        '''
+        Save the state of the system.
+            Returns:
+                snap (tuple): Copy of the current state and time (x,t).
+        '''
+        return (self.x.copy(), self.t)
+
+    def restore(self, snap):
+        '''
+        Restore a state of the system saved with snapshot.
+            Parameters:
+                snap (tuple): State and time (x,t) returned by snapshot.
+        '''
+        self.x, self.t = snap[0].copy(), snap[1]
+
     
     @abstractmethod
     def next(self):
@@ -75,7 +147,7 @@ class DynamicalSystem(ABC):
 # Continuous dynamical system
 class ContinuousDS(DynamicalSystem):
 
-    def __init__(self, x0, t0, f, jac, dt):
+    def __init__(self, x0, t0, f, jac, dt, njit = False):
         '''
         Instantiation of a dynamical system.
             Parameters:
@@ -84,20 +156,98 @@ class ContinuousDS(DynamicalSystem):
                 f (function): function f of ẋ = f(x,t) or x_(n+1) = f(x_n).
                 jac (function): jacobian of f with respect to x.
                 dt (float): time interval between two time steps.
+                njit (bool): If True, f and jac are compiled with numba and RK4 steps are done by jitted kernels (compiled at the first step).
         '''
+        if njit:
+            if numba is None:
+                raise ImportError("numba is required to use njit = True.")
+            if not numba.extending.is_jitted(f):
+                f = numba.njit(f)
+            if not numba.extending.is_jitted(jac):
+                jac = numba.njit(jac)
         super().__init__(x0, t0, f, jac, dt)
+        self.njit = njit
+        if njit:
+            self._rk4_step, self._rk4_forward = Kernels._make_rk4(f)
+        self._stages = None
+        self._LTM_buffers = None
+
     
     def next(self):
         '''
         Compute the state of the system after one time step with RK4 method.
         '''
-        k1 = self.f(self.x, self.t)
-        k2 = self.f(self.x + (self.dt / 2.) * k1, self.t + (self.dt / 2.))
-        k3 = self.f(self.x + (self.dt / 2.) * k2, self.t + (self.dt / 2.))
-        k4 = self.f(self.x + self.dt * k3, self.t + self.dt)
-        self.x = self.x + (self.dt / 6.) * (k1 + 2*k2 + 2*k3 + k4)
+        if self.njit:
+            self.x = self._rk4_step(self.x, self.t, self.dt)
+        else:
+            x, t, dt, dt2, dt6 = self.x, self.t, self.dt, self._dt_half, self._dt_sixth
+            k1 = self.f(x, t)
+            # One buffer per stage: f may return its argument (or a view of it), so k2, k3 and k4 must not alias each other
+            stage2, stage3, stage4, out = self._get_stage_buffers(np.result_type(x, k1))
+            np.multiply(k1, dt2, out = stage2)
+            np.add(x, stage2, out = stage2)
+            k2 = self.f(stage2, t + dt2)
+            np.multiply(k2, dt2, out = stage3)
+            np.add(x, stage3, out = stage3)
+            k3 = self.f(stage3, t + dt2)
+            np.multiply(k3, dt, out = stage4)
+            np.add(x, stage4, out = stage4)
+            k4 = self.f(stage4, t + dt)
+            np.add(k2, k3, out = out)
+            out *= 2.
+            out += k1
+            out += k4
+            out *= dt6
+            self.x = x + out
         self.t += self.dt
     
+    def _get_stage_buffers(self, dtype):
+        '''
+        Get the scratch arrays used by next, (re)allocated when the type changes.
+            Parameters:
+                dtype (numpy.dtype): Type of the state and of f (promoted to float if it is an integer type).
+            Returns:
+                buffers (tuple): Arrays stage2, stage3, stage4 and out of dimension self.dim.
+        '''
+        if not np.issubdtype(dtype, np.inexact):
+            dtype = np.result_type(dtype, float)
+        buffers = self._stages
+        if (buffers is None) or (buffers[0].dtype != dtype):
+            self._stages = tuple(_aligned_empty(self.dim, dtype = dtype) for _ in range(4))
+        return self._stages
+
+    def forward(self, n_steps, keep_traj):
+        '''
+        Forward the system for n_steps, in a single compiled loop if the system was created with njit = True.
+            Parameters:
+                n_steps (int): Number of simulation steps to do.
+                keep_traj (bool): Return or not the system trajectory.
+            Returns:
+                traj (numpy.ndarray): Trajectory of the system of dimension (n_steps + 1,self.dim) if keep_traj.
+        '''
+        # A subclass overriding next keeps its own stepping
+        if not (self.njit and type(self).next is ContinuousDS.next):
+            return super().forward(n_steps, keep_traj)
+        dtype = np.result_type(self.x, float)
+        traj = np.zeros((n_steps + 1 if keep_traj else 0, self.dim), dtype = dtype)
+        self.x, self.t = self._rk4_forward(np.asarray(self.x, dtype = dtype), float(self.t), self.dt, n_steps, traj)
+        if (keep_traj):
+            return traj
+    
+    def _get_LTM_buffers(self, W, order = 'F'):
+        '''
+        Get the scratch arrays used by next_LTM, (re)allocated when the shape, the type or the order changes.
+            Parameters:
+                W (numpy.ndarray): Array of deviations vectors of dimension (dim,p).
+                order (str): Memory layout of the arrays, 'F' for BLAS calls or 'C' for the jitted kernel.
+            Returns:
+                buffers (tuple): Arrays k1, k2, k3, k4, stage and out with the same shape and type as W.
+        '''
+        buffers = self._LTM_buffers
+        if (buffers is None) or (buffers[0].shape != W.shape) or (buffers[0].dtype != W.dtype) or (not buffers[0].flags[order + '_CONTIGUOUS']):
+            self._LTM_buffers = tuple(_aligned_empty(W.shape, dtype = W.dtype, order = order) for _ in range(6))
+        return self._LTM_buffers
+    
     def next_LTM(self, W):
         '''
         Compute the state of a deviation vector after one time step with RK4 method.
@@ -106,13 +256,67 @@ class ContinuousDS(DynamicalSystem):
             Returns:
                 res (numpy.ndarray): Array of deviations vectors at next time step
         '''
-        jacobian = self.jac(self.x, self.t)
-        k1 = jacobian @ W
-        k2 = jacobian @ (W + (self.dt / 2.) * k1)
-        k3 = jacobian @ (W + (self.dt / 2.) * k2)
-        k4 = jacobian @ (W + self.dt * k3)
-        res = W + (self.dt / 6.) * (k1 + 2*k2 + 2*k3 + k4)
-        return res
+        W = np.asarray(W)
+        jacobian = np.asarray(self.jac(self.x, self.t))
+        dtype = _LTM_dtype(jacobian, W)
+        W, jacobian = W.astype(dtype, copy = False), jacobian.astype(dtype, copy = False)
+        if self.njit:
+            shape = W.shape
+            W = W.reshape(self.dim, -1)
+            if not (W.flags.c_contiguous or W.flags.f_contiguous):
+                W = np.ascontiguousarray(W)
+            k, stage = self._get_LTM_buffers(W, order = 'C')[:2]
+            res = np.empty(W.shape, dtype = W.dtype)
+            Kernels._rk4_ltm(jacobian, W, self.dt, res, k, stage)
+            return res.reshape(shape)
+        dt, dt2, dt6 = self.dt, self._dt_half, self._dt_sixth
+        shape = W.shape
+        W = W.reshape(self.dim, -1)
+        # get_blas_funcs is memoized by scipy; the routine is not stored on self since it cannot be deep-copied
+        gemm = get_blas_funcs('gemm', dtype = W.dtype)
+        k1, k2, k3, k4, stage, out = self._get_LTM_buffers(W)
+        # BLAS expects Fortran order: jacobian.T is Fortran-ordered for a C-ordered jacobian, hence trans_a
+        # c is written in place when f2py does not need to copy it, the returned array is used in any case
+        jacobian_T = jacobian.T
+        k1 = gemm(1., jacobian_T, W, 0., c = k1, trans_a = 1, overwrite_c = 1)
+        np.multiply(k1, dt2, out = stage)
+        stage += W
+        k2 = gemm(1., jacobian_T, stage, 0., c = k2, trans_a = 1, overwrite_c = 1)
+        np.multiply(k2, dt2, out = stage)
+        stage += W
+        k3 = gemm(1., jacobian_T, stage, 0., c = k3, trans_a = 1, overwrite_c = 1)
+        np.multiply(k3, dt, out = stage)
+        stage += W
+        k4 = gemm(1., jacobian_T, stage, 0., c = k4, trans_a = 1, overwrite_c = 1)
+        np.add(k2, k3, out = out)
+        out *= 2.
+        out += k1
+        out += k4
+        out *= dt6
+        res = W + out
+        return res.reshape(shape)
+    
+    def forward_scipy(self, n_steps, keep_traj):
+        '''
+        Forward the system for n_steps with scipy's compiled LSODA integrator (scipy.integrate.odeint) instead of RK4.
+            Parameters:
+                n_steps (int): Number of simulation steps to do.
+                keep_traj (bool): Return or not the system trajectory.
+            Returns:
+                traj (numpy.ndarray): Trajectory of the system of dimension (n_steps + 1,self.dim) if keep_traj.
+        '''
+        # odeint allows mxstep internal steps per output interval (500 by default): a single interval gets the budget of n_steps intervals
+        if (keep_traj):
+            times = self.t + self.dt * np.arange(n_steps + 1)
+            mxstep = 500
+        else:
+            times = np.array([self.t, self.t + n_steps * self.dt])
+            mxstep = min(500 * max(n_steps, 1), np.iinfo(np.int32).max)
+        traj = odeint(self.f, self.x, times, Dfun = self.jac, mxstep = mxstep)
+        self.x = traj[-1].copy()
+        self.t = float(times[-1])
+        if (keep_traj):
+            return traj
 
 # Discrete dynamical system
 class DiscreteDS(DynamicalSystem):
@@ -127,6 +331,11 @@ class DiscreteDS(DynamicalSystem):
                 jac (function): jacobian of f with respect to x.
                 dt (float): time interval between two time steps.
         '''
+        if (len(x0) == 1):
+            # The jacobian of a one-dimensional map may be returned with shape (1,)
+            jac_1d = jac
+            def jac(x, t):
+                return np.reshape(jac_1d(x, t), (1, 1))
         super().__init__(x0, t0, f, jac, dt)
     
     def next(self):
@@ -144,9 +353,8 @@ class DiscreteDS(DynamicalSystem):
             Returns:
                 res (numpy.ndarray): Array of deviations vectors at next time step
         '''
-        jacobian = self.jac(self.x, self.t)
-        res = jacobian @ W
-        if (self.dim == 1):
-            return np.array([res])
-        else:
-            return res
\ No newline at end of file
+        W = np.asarray(W)
+        jacobian = np.asarray(self.jac(self.x, self.t))
+        dtype = _LTM_dtype(jacobian, W)
+        res = jacobian.astype(dtype, copy = False) @ W.astype(dtype, copy = False)
+        return res
\ No newline at end of file
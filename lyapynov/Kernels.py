@@ -0,0 +1,179 @@
+# Libraries
+import numpy as np
+from numba import njit, prange
+
+# RK4 step of the state, f being a jitted function
+@njit(cache = True, fastmath = True)
+def _rk4_state(f, x, t, dt):
+    '''
+    Compute the state of a continuous system after one time step with RK4 method.
+        Parameters:
+            f (function): Jitted function f of ẋ = f(x,t).
+            x (numpy.ndarray): Current state.
+            t (float): Current time.
+            dt (float): Time interval between two time steps.
+        Returns:
+            res (numpy.ndarray): State at next time step.
+    '''
+    k1 = f(x, t)
+    k2 = f(x + (dt / 2.) * k1, t + (dt / 2.))
+    k3 = f(x + (dt / 2.) * k2, t + (dt / 2.))
+    k4 = f(x + dt * k3, t + dt)
+    return x + (dt / 6.) * (k1 + 2.*k2 + 2.*k3 + k4)
+
+# RK4 kernels with f bound at compile time
+def _make_rk4(f):
+    '''
+    Build the RK4 kernels of a continuous system, f being bound at compile time (a jitted function passed as an argument is typed again at every call).
+        Parameters:
+            f (function): Jitted function f of ẋ = f(x,t).
+        Returns:
+            step (function): Jitted function (x,t,dt) returning the state at next time step.
+            forward (function): Jitted function (x,t,dt,n_steps,traj) returning (x,t) after n_steps, traj being filled with the trajectory if it has n_steps + 1 rows.
+    '''
+    @njit(fastmath = True)
+    def step(x, t, dt):
+        return _rk4_state(f, x, t, dt)
+
+    @njit(fastmath = True)
+    def forward(x, t, dt, n_steps, traj):
+        keep_traj = traj.shape[0] > 0
+        if keep_traj:
+            traj[0] = x
+        for i in range(1, n_steps + 1):
+            x = _rk4_state(f, x, t, dt)
+            t += dt
+            if keep_traj:
+                traj[i] = x
+        return x, t
+
+    return step, forward
+
+# RK4 step of the deviation vectors
+@njit(cache = True, fastmath = True)
+def _rk4_ltm(jacobian, W, dt, res, k, stage):
+    '''
+    Compute the state of deviation vectors after one time step with RK4 method, without allocating.
+        Parameters:
+            jacobian (numpy.ndarray): Jacobian of f at the current state, of dimension (dim,dim).
+            W (numpy.ndarray): Array of deviations vectors of dimension (dim,p).
+            dt (float): Time interval between two time steps.
+            res (numpy.ndarray): C-ordered output array of dimension (dim,p), receives the deviations vectors at next time step.
+            k (numpy.ndarray): C-ordered scratch array of dimension (dim,p).
+            stage (numpy.ndarray): C-ordered scratch array of dimension (dim,p).
+    '''
+    dim, p = W.shape
+    res[:] = W
+    np.dot(jacobian, W, k)
+    for coef_stage, coef_res in ((dt / 2., dt / 6.), (dt / 2., dt / 3.), (dt, dt / 3.)):
+        for i in range(dim):
+            for j in range(p):
+                res[i,j] += coef_res * k[i,j]
+                stage[i,j] = W[i,j] + coef_stage * k[i,j]
+        np.dot(jacobian, stage, k)
+    for i in range(dim):
+        for j in range(p):
+            res[i,j] += (dt / 6.) * k[i,j]
+
+# Normalize the columns of a matrix in place
+@njit(cache = True)
+def _normalize_columns(A):
+    '''
+    Normalize the columns of a matrix in place.
+        Parameters:
+            A (numpy.ndarray): Matrix of dimension (n,p).
+    '''
+    n, p = A.shape
+    for j in range(p):
+        norm = 0.
+        for i in range(n):
+            norm += A[i,j] * A[i,j]
+        norm = np.sqrt(norm)
+        for i in range(n):
+            A[i,j] /= norm
+
+# Solve R X = B in place for an upper triangular R
+@njit(cache = True)
+def _solve_upper(R, B):
+    '''
+    Solve R X = B by back substitution, X being written in B.
+        Parameters:
+            R (numpy.ndarray): Upper triangular matrix of dimension (p,p).
+            B (numpy.ndarray): Right-hand side of dimension (p,m), overwritten by the solution.
+    '''
+    p, m = B.shape
+    for j in range(m):
+        for i in range(p - 1, -1, -1):
+            s = B[i,j]
+            for k in range(i + 1, p):
+                s -= R[i,k] * B[k,j]
+            B[i,j] = s / R[i,i]
+
+# Backward recursion of CLV computation
+@njit(cache = True)
+def _backward_clv(R_stack1, R_stack2, Phi_stack, A0):
+    '''
+    Compute CLV from the stored Phi and R matrices.
+        Parameters:
+            R_stack1 (numpy.ndarray): R matrices stored during the n_B steps, of dimension (n_B,p,p).
+            R_stack2 (numpy.ndarray): R matrices stored during the n_C steps, of dimension (n_C,p,p).
+            Phi_stack (numpy.ndarray): Phi matrices stored during the n_B steps, of dimension (n_B+1,dim,p).
+            A0 (numpy.ndarray): Initial upper triangular matrix A of dimension (p,p).
+        Returns:
+            CLV (numpy.ndarray): CLV at each of the n_B+1 time steps, of dimension (n_B+1,dim,p).
+    '''
+    n_B = R_stack1.shape[0]
+    A = A0.copy()
+
+    # Make A converge to A-
+    for n in range(R_stack2.shape[0] - 1, -1, -1):
+        _normalize_columns(A)
+        _solve_upper(R_stack2[n], A)
+
+    # Compute CLV
+    CLV = np.empty_like(Phi_stack)
+    CLV[n_B] = Phi_stack[n_B] @ A
+    for n in range(n_B - 1, -1, -1):
+        _normalize_columns(A)
+        _solve_upper(R_stack1[n], A)
+        CLV[n] = Phi_stack[n] @ A
+        _normalize_columns(CLV[n])
+    return CLV
+
+# LCE of an ensemble of trajectories computed in parallel
+@njit(parallel = True, cache = True)
+def _lce_batch(f, jac, X0, t0, dt, n_forward, n_compute, p):
+    '''
+    Compute LCE of a continuous system for a batch of initial conditions, one trajectory per thread.
+        Parameters:
+            f (function): Jitted function f of ẋ = f(x,t).
+            jac (function): Jitted jacobian of f with respect to x.
+            X0 (numpy.ndarray): Initial conditions of dimension (n_batch,dim).
+            t0 (float): Initial time.
+            dt (float): Time interval between two time steps.
+            n_forward (int): Number of steps before starting the LCE computation.
+            n_compute (int): Number of steps to compute the LCE.
+            p (int): Number of LCE to compute.
+        Returns:
+            LCE (numpy.ndarray): Lyapunov Charateristic Exponents of dimension (n_batch,p).
+    '''
+    n_batch, dim = X0.shape
+    LCE = np.zeros((n_batch, p))
+    for b in prange(n_batch):
+        x, t = X0[b].copy(), t0
+        for _ in range(n_forward):
+            x = _rk4_state(f, x, t, dt)
+            t += dt
+        W = np.zeros((dim, p))
+        for j in range(p):
+            W[j,j] = 1.
+        res, k, stage = np.empty((dim, p)), np.empty((dim, p)), np.empty((dim, p))
+        for _ in range(n_compute):
+            _rk4_ltm(jac(x, t), W, dt, res, k, stage)
+            x = _rk4_state(f, x, t, dt)
+            t += dt
+            Q, R = np.linalg.qr(res)
+            W = np.ascontiguousarray(Q)
+            for j in range(p):
+                LCE[b,j] += np.log(np.abs(R[j,j]))
+    return LCE / (n_compute * dt)
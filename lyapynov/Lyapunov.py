@@ -1,9 +1,114 @@
 # Libraires
 import numpy as np
+from scipy.linalg import solve_triangular
+from scipy.linalg.lapack import get_lapack_funcs
 from . import DynamicalSystem
+try:
+    from . import Kernels
+except ImportError:
+    Kernels = None
+
+# Build a QR decomposition calling LAPACK directly
+def _QR(W):
+    '''
+    Build a function computing the reduced QR decomposition of arrays with the same shape and dtype as W.
+        Parameters:
+            W (numpy.ndarray): Array of deviations vectors of dimension (dim,p).
+        Returns:
+            QR (function): Function returning (Q,R) for an array of deviations vectors (the array is overwritten).
+    '''
+    p = W.shape[1]
+    geqrf, orgqr = get_lapack_funcs(('geqrf', 'orgqr'), (W,))
+    qr, tau, work, _ = geqrf(W, lwork = -1)
+    lwork_geqrf = int(work[0])
+    _, work, _ = orgqr(qr, tau, lwork = -1)
+    lwork_orgqr = int(work[0])
+
+    def QR(W):
+        qr, tau, _, _ = geqrf(W, lwork = lwork_geqrf, overwrite_a = 1)
+        R = np.triu(qr[:p])
+        Q, _, _ = orgqr(qr, tau, lwork = lwork_orgqr, overwrite_a = 1)
+        return Q, R
+    return QR
+
+# Import cupy only if it can run on a GPU
+def _get_cupy():
+    '''
+    Import cupy and check that a CUDA device is available.
+        Returns:
+            cupy (module): cupy module, None if cupy is not installed or no CUDA device is available.
+    '''
+    try:
+        import cupy
+        if cupy.cuda.runtime.getDeviceCount() > 0:
+            return cupy
+    except Exception:
+        pass
+    return None
+
+# Backward recursion of CLV computation on GPU
+def _backward_clv_gpu(cupy, R_stack1, R_stack2, Phi_stack, A):
+    '''
+    Compute CLV from the stored Phi and R matrices on GPU with cupy.
+        Parameters:
+            cupy (module): cupy module returned by _get_cupy.
+            R_stack1 (numpy.ndarray): R matrices stored during the n_B steps, of dimension (n_B,p,p).
+            R_stack2 (numpy.ndarray): R matrices stored during the n_C steps, of dimension (n_C,p,p).
+            Phi_stack (numpy.ndarray): Phi matrices stored during the n_B steps, of dimension (n_B+1,dim,p).
+            A (numpy.ndarray): Initial upper triangular matrix A of dimension (p,p).
+        Returns:
+            CLV (numpy.ndarray): CLV at each of the n_B+1 time steps, of dimension (n_B+1,dim,p).
+    '''
+    from cupyx.scipy.linalg import solve_triangular as cupy_solve_triangular
+    n_B = R_stack1.shape[0]
+    R_stack1, R_stack2, Phi_stack, A = cupy.asarray(R_stack1), cupy.asarray(R_stack2), cupy.asarray(Phi_stack), cupy.asarray(A)
+
+    # Make A converge to A-
+    for i in range(R_stack2.shape[0] - 1, -1, -1):
+        A /= cupy.linalg.norm(A, axis = 0)
+        A = cupy_solve_triangular(R_stack2[i], A, lower = False, overwrite_b = True)
+
+    # Compute CLV, the normalization being done once for all time steps
+    CLV_stack = cupy.empty_like(Phi_stack)
+    cupy.matmul(Phi_stack[n_B], A, out = CLV_stack[n_B])
+    for i in range(n_B - 1, -1, -1):
+        A /= cupy.linalg.norm(A, axis = 0)
+        A = cupy_solve_triangular(R_stack1[i], A, lower = False, overwrite_b = True)
+        cupy.matmul(Phi_stack[i], A, out = CLV_stack[i])
+    CLV_stack[:n_B] /= cupy.linalg.norm(CLV_stack[:n_B], axis = 1, keepdims = True)
+    return CLV_stack.get()
+
+# Forward the system before a computation
+def _transient(system : DynamicalSystem, n_forward : int):
+    '''
+    Forward the system for n_forward steps, with scipy's compiled integrator for continuous systems
+    whose stepping is not overridden by a subclass.
+        Parameters:
+            system (DynamicalSystem): Dynamical system to forward.
+            n_forward (int): Number of steps to do.
+    '''
+    cls = type(system)
+    if isinstance(system, DynamicalSystem.ContinuousDS) and (cls.next is DynamicalSystem.ContinuousDS.next) and (cls.forward is DynamicalSystem.ContinuousDS.forward):
+        system.forward_scipy(n_forward, False)
+    else:
+        system.forward(n_forward, False)
+
+# One step of the system in the loops
+def _step(system : DynamicalSystem):
+    '''
+    Get a function doing one step of the system: its next method, or forward(1, False) if a subclass overrides forward.
+        Parameters:
+            system (DynamicalSystem): Dynamical system to step.
+        Returns:
+            step (function): Function without arguments doing one step of the system.
+    '''
+    forward = type(system).forward
+    if (forward is DynamicalSystem.DynamicalSystem.forward) or (forward is DynamicalSystem.ContinuousDS.forward):
+        return system.next
+    return lambda: system.forward(1, False)
 
 # Compute maximal 1-LCE
-def mLCE(system : DynamicalSystem, n_forward : int, n_compute : int, keep : bool):
+def mLCE(system : DynamicalSystem, n_forward : int, n_compute : int, keep : bool, dtype = np.float64):
     '''
     Compute the maximal 1-LCE.
         Parameters:
@@ -11,38 +116,45 @@ def mLCE(system : DynamicalSystem, n_forward : int, n_compute : int, keep : bool
             n_forward (int): Number of steps before starting the mLCE computation. 
             n_compute (int): Number of steps to compute the mLCE, can be adjusted using keep_evolution.
             keep (bool): If True return a numpy array of dimension (n_compute,) containing the evolution of mLCE.
+            dtype (numpy.dtype): Type of deviation vectors and QR decompositions, np.float32 gives faster but less precise runs (exponents are always accumulated in float64).
         Returns:
             mLCE (float): Maximum 1-LCE.
             history (numpy.ndarray): Evolution of mLCE during the computation.
     '''
     # Forward the system before the computation of mLCE
-    system.forward(n_forward, False)
+    _transient(system, n_forward)
     
+    # Bind methods to locals to avoid attribute lookups in the loops
+    next_LTM, step = system.next_LTM, _step(system)
+
     # Compute the mLCE
     mLCE = 0.
-    w = np.random.rand(system.dim)
+    w = np.random.rand(system.dim, 1).astype(dtype)
     w = w / np.linalg.norm(w)
     if keep:
         history = np.zeros(n_compute)
+        inv_dt = 1. / system.dt
         for i in range(1, n_compute + 1):
-            w = system.next_LTM(w)
-            system.forward(1, False)
-            mLCE += np.log(np.linalg.norm(w))
-            history[i-1] = mLCE / (i * system.dt)
-            w = w / np.linalg.norm(w)
+            w = next_LTM(w)
+            step()
+            norm = float(np.linalg.norm(w))
+            mLCE += np.log(norm)
+            history[i-1] = mLCE * inv_dt / i
+            w /= norm
         mLCE = mLCE / (n_compute * system.dt)
         return mLCE, history
     else:
         for _ in range(n_compute):
-            w = system.next_LTM(w)
-            system.forward(1, False)
-            mLCE += np.log(np.linalg.norm(w))
-            w = w / np.linalg.norm(w)
+            w = next_LTM(w)
+            step()
+            norm = float(np.linalg.norm(w))
+            mLCE += np.log(norm)
+            w /= norm
         mLCE = mLCE / (n_compute * system.dt)
         return mLCE
 
 # Compute LCE
-def LCE(system : DynamicalSystem, p : int, n_forward : int, n_compute : int, keep : bool):
+def LCE(system : DynamicalSystem, p : int, n_forward : int, n_compute : int, keep : bool, dtype = np.float64):
     '''
     Compute LCE.
         Parameters:
@@ -51,39 +163,75 @@ def LCE(system : DynamicalSystem, p : int, n_forward : int, n_compute : int, kee
             n_forward (int): Number of steps before starting the LCE computation. 
             n_compute (int): Number of steps to compute the LCE, can be adjusted using keep_evolution.
             keep (bool): If True return a numpy array of dimension (n_compute,p) containing the evolution of LCE.
+            dtype (numpy.dtype): Type of deviation vectors and QR decompositions, np.float32 gives faster but less precise runs (exponents are always accumulated in float64).
         Returns:
             LCE (numpy.ndarray): Lyapunov Charateristic Exponents.
             history (numpy.ndarray): Evolution of LCE during the computation.
     '''
+    # With a single exponent QR reduces to a normalization, as in mLCE
+    if (p == 1):
+        if keep:
+            res, history = mLCE(system, n_forward, n_compute, True, dtype)
+            return np.array([res]), history[:,None]
+        else:
+            return np.array([mLCE(system, n_forward, n_compute, False, dtype)])
+
     # Forward the system before the computation of LCE
-    system.forward(n_forward, False)
+    _transient(system, n_forward)
+
+    # Bind methods to locals to avoid attribute lookups in the loops
+    next_LTM, step = system.next_LTM, _step(system)
 
     # Computation of LCE
-    W = np.eye(system.dim)[:,:p]
+    W = DynamicalSystem._aligned_empty((system.dim, p), dtype = dtype, order = 'F')
+    W[:] = 0.
+    np.fill_diagonal(W, 1.)
+    QR = _QR(W)
     LCE = np.zeros(p)
     if keep:
         history = np.zeros((n_compute, p))
+        inv_dt = 1. / system.dt
         for i in range(1, n_compute + 1):
-            W = system.next_LTM(W)
-            system.forward(1, False)
-            W, R = np.linalg.qr(W)
-            for j in range(p):
-                LCE[j] += np.log(np.abs(R[j,j]))
-                history[i-1,j] = LCE[j] / (i * system.dt)
+            W = next_LTM(W)
+            step()
+            W, R = QR(W)
+            LCE += np.log(np.abs(np.diag(R)).astype(np.float64))
+            history[i-1] = LCE * (inv_dt / i)
         LCE = LCE / (n_compute * system.dt)
         return LCE, history
     else:
         for _ in range(n_compute):
-            W = system.next_LTM(W)
-            system.forward(1, False)
-            W, R = np.linalg.qr(W)
-            for j in range(p):
-                LCE[j] += np.log(np.abs(R[j,j]))
+            W = next_LTM(W)
+            step()
+            W, R = QR(W)
+            LCE += np.log(np.abs(np.diag(R)).astype(np.float64))
         LCE = LCE / (n_compute * system.dt)
         return LCE
 
+# Compute LCE for an ensemble of initial conditions
+def LCE_ensemble(system : DynamicalSystem, p : int, n_forward : int, n_compute : int, x0_batch : np.ndarray):
+    '''
+    Compute LCE for an ensemble of initial conditions, the trajectories being computed in parallel with numba.
+        Parameters:
+            system (DynamicalSystem): Continuous dynamical system created with njit = True (its state is not modified).
+            p (int): Number of LCE to compute.
+            n_forward (int): Number of steps before starting the LCE computation. 
+            n_compute (int): Number of steps to compute the LCE.
+            x0_batch (numpy.ndarray): Initial conditions of dimension (n_batch,system.dim), taken at time system.t.
+        Returns:
+            LCE (numpy.ndarray): Lyapunov Charateristic Exponents of each trajectory, of dimension (n_batch,p).
+    '''
+    if not (isinstance(system, DynamicalSystem.ContinuousDS) and system.njit):
+        raise ValueError("LCE_ensemble requires a ContinuousDS created with njit = True.")
+    if not (1 <= p <= system.dim):
+        raise ValueError("p must be between 1 and system.dim.")
+    X0 = np.ascontiguousarray(x0_batch, dtype = float)
+    if (X0.ndim != 2) or (X0.shape[1] != system.dim):
+        raise ValueError("x0_batch must be of dimension (n_batch,system.dim).")
+    return Kernels._lce_batch(system.f, system.jac, X0, float(system.t), float(system.dt), n_forward, n_compute, p)
+
 # Compute CLV
-def CLV(system : DynamicalSystem, p : int, n_forward : int, n_A : int, n_B : int, n_C : int, traj : bool, check = False):
+def CLV(system : DynamicalSystem, p : int, n_forward : int, n_A : int, n_B : int, n_C : int, traj : bool, check = False, dtype = np.float64, backend = 'cpu'):
     '''
     Compute CLV.
         Parameters:
@@ -94,72 +242,102 @@ def CLV(system : DynamicalSystem, p : int, n_forward : int, n_A : int, n_B : int
             n_B (int): Number of time steps for which Phi and R matrices are stored and for which CLV are computed.
             n_C (int): Number of steps for which R matrices are stored in order to converge A to A-. 
             traj (bool): If True return a numpy array of dimension (n_B,system.dim) containing system's trajectory at the times CLV are computed.
+            check (bool): If True also return a copy of the system in its state at the first time step for which CLV are computed.
+            dtype (numpy.dtype): Type of deviation vectors and QR decompositions, np.float32 gives faster but less precise runs (exponents are always accumulated in float64).
+            backend (str): Device of the backward recursion, 'cpu', 'gpu' (requires cupy and a CUDA device) or 'auto' (GPU only for systems with system.dim*p > 4096 when one is available).
         Returns:
             CLV (List): List of numpy.array containing CLV computed during n_B time steps.
             history (numpy.ndarray): Trajectory of the system during the computation of CLV.
+            checker (DynamicalSystem): Copy of the system at the first time step for which CLV are computed (if check).
     '''
+    # Select the device of the backward recursion before any computation
+    if backend not in ('cpu', 'gpu', 'auto'):
+        raise ValueError("backend must be 'cpu', 'gpu' or 'auto'.")
+    cupy = _get_cupy() if (backend == 'gpu') or (backend == 'auto' and system.dim * p > 4096) else None
+    if (backend == 'gpu') and (cupy is None):
+        raise RuntimeError("backend = 'gpu' requires cupy and a CUDA device.")
+
     # Forward the system before the computation of CLV
-    system.forward(n_forward, False)
+    _transient(system, n_forward)
+
+    # Bind methods to locals to avoid attribute lookups in the loops
+    next_LTM, step = system.next_LTM, _step(system)
 
     # Make W converge to Phi
-    W = np.eye(system.dim)[:,:p]
+    W = DynamicalSystem._aligned_empty((system.dim, p), dtype = dtype, order = 'F')
+    W[:] = 0.
+    np.fill_diagonal(W, 1.)
+    QR = _QR(W)
     for _ in range(n_A):
-        W = system.next_LTM(W)
-        W, _ = np.linalg.qr(W)
-        system.forward(1, False)
+        W = next_LTM(W)
+        W, _ = QR(W)
+        step()
     
     # We continue but now Q and R are stored to compute CLV later
-    Phi_list, R_list1 = [W], []
+    Phi_stack, R_stack1 = np.empty((n_B+1, system.dim, p), dtype = dtype), np.empty((n_B, p, p), dtype = dtype)
+    Phi_stack[0] = W
     if traj:
         history = np.zeros((n_B+1, system.dim))
         history[0,:] = system.x
     if check:
-        copy = system.copy()
+        snapshot = system.snapshot()
     for i in range(n_B):
-        W = system.next_LTM(W)
-        W, R = np.linalg.qr(W)
-        Phi_list.append(W)
-        R_list1.append(R)
-        system.forward(1, False)
+        W = next_LTM(W)
+        W, R = QR(W)
+        Phi_stack[i+1] = W
+        R_stack1[i] = R
+        step()
         if traj:
             history[i+1,:] = system.x
     
     # Now we only store R to compute A- later
-    R_list2 = []
-    for _ in range(n_C):
-        W = system.next_LTM(W)
-        W, R = np.linalg.qr(W)
-        R_list2.append(R)
-        system.forward(1, False)
+    R_stack2 = np.empty((n_C, p, p), dtype = dtype)
+    for i in range(n_C):
+        W = next_LTM(W)
+        W, R = QR(W)
+        R_stack2[i] = R
+        step()
     
-    # Generate A make it converge to A-
-    A = np.triu(np.random.rand(p,p))
-    for R in reversed(R_list2):
-        C = np.diag(1. / np.linalg.norm(A, axis = 0))
-        B = A @ C
-        A = np.linalg.solve(R, B)
-    del R_list2
-
-    # Compute CLV
-    CLV = [Phi_list[-1] @ A]
-    for Q, R in zip(reversed(Phi_list[:-1]), reversed(R_list1)):
-        C = np.diag(1. / np.linalg.norm(A, axis = 0))
-        B = A @ C
-        A = np.linalg.solve(R, B)
-        CLV_t = Q @ A
-        CLV.append(CLV_t / np.linalg.norm(CLV_t, axis = 0))
-    del R_list1
-    del Phi_list
-    CLV.reverse()
+    # Generate A
+    A = np.triu(np.random.rand(p,p)).astype(dtype)
+
+    # Backward recursion on GPU if selected, in compiled code if numba is available
+    if cupy is not None:
+        CLV_stack = _backward_clv_gpu(cupy, R_stack1, R_stack2, Phi_stack, A)
+    elif Kernels is not None:
+        CLV_stack = Kernels._backward_clv(R_stack1, R_stack2, Phi_stack, A)
+    else:
+        # Make A converge to A-
+        for i in range(n_C - 1, -1, -1):
+            A /= np.linalg.norm(A, axis = 0)
+            A = solve_triangular(R_stack2[i], A, lower = False, overwrite_b = True, check_finite = False)
+
+        # Compute CLV
+        CLV_stack = np.empty_like(Phi_stack)
+        np.matmul(Phi_stack[-1], A, out = CLV_stack[-1])
+        for i in range(n_B - 1, -1, -1):
+            A /= np.linalg.norm(A, axis = 0)
+            A = solve_triangular(R_stack1[i], A, lower = False, overwrite_b = True, check_finite = False)
+            np.matmul(Phi_stack[i], A, out = CLV_stack[i])
+            CLV_stack[i] /= np.linalg.norm(CLV_stack[i], axis = 0)
+    del R_stack1
+    del R_stack2
+    del Phi_stack
+    CLV = list(CLV_stack)
+
+    # Copy of the system put back in its state at the first CLV time step
+    if check:
+        checker = system.copy()
+        checker.restore(snapshot)
 
     if traj:
         if check:
-            return CLV, history, copy
+            return CLV, history, checker
         else:
             return CLV, history
     else:
         if check:
-            return CLV, copy
+            return CLV, checker
         else:
             return CLV
 
@@ -177,14 +355,18 @@ def ADJ(CLV : list):
         try:
             ADJ_t = np.linalg.solve(np.transpose(CLV[n]), np.eye(CLV[n].shape[0]))
             ADJ.append(ADJ_t / np.linalg.norm(ADJ_t, axis = 0))
-        except:
-            ADJ_t = np.zeros_like(CLV[n])
-            for j in range(ADJ_t.shape[1]):
-                columns = [i for i in range(ADJ_t.shape[1])]
-                columns.remove(j)
-                A = np.transpose(CLV[n][:,columns])
-                _, _, Vh = np.linalg.svd(A)
-                theta_j = Vh[-1] / np.linalg.norm(Vh[-1])
-                ADJ_t[:,j] = theta_j
-            ADJ.append(ADJ_t)
+        except np.linalg.LinAlgError:
+            # CLV(t) is not square or is singular: use the pseudo-inverse of its transpose
+            U, s, Vh = np.linalg.svd(np.transpose(CLV[n]), full_matrices = False)
+            s_inv = np.zeros_like(s)
+            mask = s > max(CLV[n].shape) * np.finfo(s.dtype).eps * s[0]
+            s_inv[mask] = 1. / s[mask]
+            ADJ_t = (np.transpose(Vh) * s_inv) @ np.transpose(U)
+            # Columns lying only along discarded singular directions vanish: take a vector orthogonal to the other CLV instead
+            norms = np.linalg.norm(ADJ_t, axis = 0)
+            for j in np.flatnonzero(norms <= max(CLV[n].shape) * np.finfo(norms.dtype).eps * norms.max()):
+                _, _, Vh_j = np.linalg.svd(np.transpose(np.delete(CLV[n], j, axis = 1)))
+                ADJ_t[:,j] = Vh_j[-1]
+                norms[j] = np.linalg.norm(Vh_j[-1])
+            ADJ.append(ADJ_t / norms)
     return ADJ
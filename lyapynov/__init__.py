@@ -7,5 +7,6 @@ from lyapynov.DynamicalSystem import ContinuousDS
 from lyapynov.DynamicalSystem import DiscreteDS
 from lyapynov.Lyapunov import mLCE
 from lyapynov.Lyapunov import LCE
+from lyapynov.Lyapunov import LCE_ensemble
 from lyapynov.Lyapunov import CLV
 from lyapynov.Lyapunov import ADJ
\ No newline at end of file
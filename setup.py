@@ -15,7 +15,8 @@ setup(
     packages=find_packages(),
     keywords='Lyapunov, Lyapunov exponents, LCE, Covariant Lyapunov vectors, CLV, Dynamical systems, ODE',
     python_requires='>=3.8',
-    install_requires=['numpy', 'matplotlib'],
+    install_requires=['numpy', 'scipy', 'matplotlib'],
+    extras_require={'numba': ['numba'], 'gpu': ['cupy']},
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Intended Audience :: Science/Research",